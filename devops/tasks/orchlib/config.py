@@ -1,11 +1,22 @@
+import functools
 import os
 import os.path
 
 import json
 import yaml
 
+try:
+    # libyaml-backed loader; much faster than the pure-Python one
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 creds_file = "settings/CREDS.YAML"
 
+# Set to `True` to print every path we check when searching for
+# config files
+DEBUG = False
+
 if not os.path.exists(creds_file):
     print("No credentials file. I'll need a bit of info from you")
     print("to make one.")
@@ -37,7 +48,11 @@ if not os.path.exists(creds_file):
     with open("settings/CREDS.YAML", "w") as fp:
         yaml.dump(d, fp)
 
-creds = yaml.safe_load(open(creds_file))
+with open(creds_file) as fp:
+    creds = yaml.load(fp, Loader=SafeLoader)
+
+FLOCK_CONFIG = creds["flock-config"]
+
 
 def config_filename(machine_name, file_suffix, create=False):
     '''
@@ -48,35 +63,62 @@ def config_filename(machine_name, file_suffix, create=False):
 
     Absolute paths (e.g. beginning with '/') are returned as-is.
     '''
-    if file_suffix.startswith("/"):
+    if file_suffix[:1] == "/":
         return file_suffix
 
-    paths = [
+    # For making new versions, always return the per-machine git repo
+    # directory. The caller is about to create a file there, so any
+    # cached lookups may be stale.
+    if create == True:
+        _find_config_file.cache_clear()
+        return _config_paths(machine_name, file_suffix)[0]
+
+    return _find_config_file(machine_name, file_suffix)
+
+
+@functools.lru_cache(maxsize=64)
+def _prefixes(machine_name):
+    '''
+    The directories we search for config files for a machine, in order
+    of priority: per-machine, system-wide, and the defaults in this
+    repo.
+    '''
+    system_dir = os.path.join(FLOCK_CONFIG, "config")
+    return (
+        os.path.join(system_dir, machine_name),
+        system_dir,
+        "config"
+    )
+
+
+def _config_paths(machine_name, file_suffix):
+    '''
+    The places we look for a config file, in order of priority.
+    '''
+    machine_dir, system_dir, default_dir = _prefixes(machine_name)
+    return [
         # First, we try per-machine configuration
-        os.path.join(
-            creds["flock-config"], "config", machine_name, file_suffix
-        ),
+        os.path.join(machine_dir, file_suffix),
         # Next, we try the per-machine override
-        os.path.join(
-            creds["flock-config"], "config", machine_name, file_suffix+".base"
-        ),
+        os.path.join(machine_dir, file_suffix+".base"),
         # Then, system-wide configuration
-        os.path.join(
-            creds["flock-config"], "config", file_suffix
-        ),
+        os.path.join(system_dir, file_suffix),
         # And finally, as a fallback, default files
-        os.path.join(
-            "config", file_suffix
-        )
+        os.path.join(default_dir, file_suffix)
     ]
 
-    # For making new versions, always return the per-machine git repo
-    # directory
-    if create == True:
-        return paths[0]
 
-    for fn in paths:
-        print(fn)
+@functools.lru_cache(maxsize=256)
+def _find_config_file(machine_name, file_suffix):
+    '''
+    Return the first config file which exists, or `None`.
+
+    We look up the same files many times over the course of a run, so
+    we cache this to avoid hitting the file system each time.
+    '''
+    for fn in _config_paths(machine_name, file_suffix):
+        if DEBUG:
+            print(fn)
         if os.path.exists(fn):
             return fn
 
@@ -94,7 +136,8 @@ def config_lines(machine_name, file_suffix):
         print("Skipping; no file for: ", file_suffix)
         return
     print("Config file: ", fn)
-    for line in open(fn).readlines():
-        line = line.strip()
-        if len(line) > 0:
-            yield line
+    with open(fn) as fp:
+        for line in fp:
+            line = line.strip()
+            if len(line) > 0 and not line.startswith("#"):
+                yield line
@@ -12,19 +12,94 @@ To read objects:
 '''
 
 import asyncio
+import collections
 import copy
+import fnmatch
 import json
 import sys
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 import learning_observer.prestartup
 import learning_observer.settings
 import learning_observer.redis
 
 OBJECT_STORE = dict()
 
+# Compact JSON: no spaces after `,` and `:`
+_SEPARATORS = (",", ":")
+
+# `json.dumps` with non-default arguments builds a new encoder on every
+# call, so we make one up front.
+#
+# We keep `ensure_ascii` on. Keystrokes can carry half of a surrogate
+# pair (e.g. half an emoji), which can't be written as UTF-8, so it has
+# to be escaped before it goes to redis.
+_ENCODE = json.JSONEncoder(separators=_SEPARATORS).encode
+
+# How many keys we fetch per round-trip when dumping the KVS
+_DUMP_BATCH_SIZE = 500
+
+# How many keys we ask redis for per `SCAN` round-trip. The
+# `asyncio_redis` default is 10, which makes walking a big keyspace
+# very chatty.
+_SCAN_COUNT = 1000
+
+# The in-memory KVS keeps values serialized. Decoding gives each reader
+# a fresh copy, which is much faster than `copy.deepcopy`, and bytes are
+# more compact than nested Python objects. The codec can be picked with
+# `kvs.inmemory_codec` in settings:
+#
+# * `json` (default) uses the same encoder as the redis KVS, so it
+#   accepts and rejects exactly the same values.
+# * `orjson` is faster, but looser: it turns `datetime`, `UUID`,
+#   dataclasses and numpy values into JSON, writes NaN as `null`, and
+#   rejects integers over 64 bits and lone surrogates. Code which works
+#   with it may fail with redis.
+# * `msgpack` is faster than JSON on dict-heavy objects, and smaller,
+#   but unlike JSON, it keeps non-string dictionary keys and bytes
+#   as-is. It has the same caveat as `orjson`.
+# * `deepcopy` stores live objects, and copies them on read and write
+
+
+def _deepcopy_pack(value):
+    _ENCODE(value)  # Fail early if we're not JSON
+    return copy.deepcopy(value)
+
+
+def _orjson_pack(value):
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _msgpack_unpack(item):
+    return msgpack.unpackb(item, raw=False, strict_map_key=False)
+
+
+INMEMORY_CODECS = {
+    'deepcopy': (_deepcopy_pack, copy.deepcopy),
+    'json': (_ENCODE, json.loads)
+}
+if orjson is not None:
+    INMEMORY_CODECS['orjson'] = (_orjson_pack, orjson.loads)
+if msgpack is not None:
+    INMEMORY_CODECS['msgpack'] = (msgpack.packb, _msgpack_unpack)
+
+DEFAULT_INMEMORY_CODEC = 'json'
+
+# Set by `kvs_startup_check`
+_pack, _unpack = INMEMORY_CODECS[DEFAULT_INMEMORY_CODEC]
+
 
 class _KVS:
-    async def dump(self, filename=None):
+    async def dump(self, filename=None, pretty=False):
         '''
         Dumps the entire contents of the KVS to a JSON object.
 
@@ -41,16 +116,31 @@ class _KVS:
 
         args:
             filename: The filename to write to. If `None`, don't write to a file.
+            pretty: Indent the file, for humans. This is slower.
 
         returns:
             A JSON object containing the contents of the KVS.
         '''
         data = {}
-        for key in await self.keys():
-            data[key] = await self[key]
+        batch = []
+        async for key in self.iter_keys():
+            batch.append(key)
+            if len(batch) >= _DUMP_BATCH_SIZE:
+                data.update(zip(batch, await self.mget(batch)))
+                batch = []
+        if batch:
+            data.update(zip(batch, await self.mget(batch)))
         if filename:
+            # We don't use `orjson` here. It can't write everything the
+            # KVS accepts (lone surrogates, big ints), and it quietly
+            # writes NaN as `null`. We encode before opening the file,
+            # so a failure doesn't clobber an existing dump.
+            if pretty:
+                payload = json.dumps(data, indent=4)
+            else:
+                payload = _ENCODE(data)
             with open(filename, 'w') as f:
-                json.dump(data, f, indent=4)
+                f.write(payload)
         return data
 
     async def load(self, filename):
@@ -61,8 +151,17 @@ class _KVS:
         intended to be used in production, as it is not very performant. It can
         be helpful for offline analytics too, at least at a small scale.
         '''
-        with open(filename) as f:
-            data = json.load(f)
+        with open(filename, 'rb') as f:
+            raw = f.read()
+        if orjson is not None:
+            # `orjson` is stricter than `json`. Files written by `json`
+            # may have NaN or escaped lone surrogates, which it rejects.
+            try:
+                data = orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                data = json.loads(raw)
+        else:
+            data = json.loads(raw)
         for key, value in data.items():
             await self.set(key, value)
 
@@ -77,7 +176,18 @@ class InMemoryKVS(_KVS):
 
         >> await kvs['item']
         '''
-        return copy.deepcopy(OBJECT_STORE.get(key, None))
+        item = OBJECT_STORE.get(key, None)
+        if item is not None:
+            return _unpack(item)
+        return None
+
+    async def mget(self, keys):
+        '''
+        Fetch several items at once. Returns a list of values, in the
+        same order as `keys`, with `None` for missing items.
+        '''
+        items = [OBJECT_STORE.get(key, None) for key in keys]
+        return [_unpack(item) if item is not None else None for item in items]
 
     async def set(self, key, value):
         '''
@@ -92,17 +202,34 @@ class InMemoryKVS(_KVS):
 
         So we use an explict set function.
         '''
-        json.dumps(value)  # Fail early if we're not JSON
         assert isinstance(key, str), "KVS keys must be strings"
-        OBJECT_STORE[key] = value
+        # With the default `json` codec, this fails if we're not JSON,
+        # just like redis. See the codec notes above.
+        OBJECT_STORE[key] = _pack(value)
 
-    async def keys(self):
+    async def keys(self, pattern="*"):
         '''
-        Returns all keys.
+        Returns all keys matching `pattern`, a redis-style glob.
+        '''
+        if pattern == "*":
+            return list(OBJECT_STORE)
+        return [key async for key in self.iter_keys(pattern)]
 
-        Eventually, this might support wildcards.
+    async def iter_keys(self, pattern="*"):
         '''
-        return list(OBJECT_STORE.keys())
+        Iterate over the keys matching `pattern`, without making a
+        list of them first.
+
+        This walks the store directly, so don't add or remove items
+        while iterating.
+
+        Syntax:
+
+        >> async for key in kvs.iter_keys():
+        '''
+        for key in OBJECT_STORE:
+            if pattern == "*" or fnmatch.fnmatchcase(key, pattern):
+                yield key
 
     async def clear(self):
         '''
@@ -122,6 +249,7 @@ class _RedisKVS(_KVS):
     '''
     def __init__(self, expire):
         self.expire = expire
+        self._conn = None
 
     async def connect(self):
         '''
@@ -130,19 +258,46 @@ class _RedisKVS(_KVS):
         '''
         await learning_observer.redis.connect()
 
+    async def _connection(self):
+        '''
+        Return our redis connection, connecting on first use.
+
+        We hold on to the handle so each operation doesn't go through
+        `connect()` again. `asyncio_redis` reconnects on its own, so the
+        handle stays good if the server drops us.
+        '''
+        if self._conn is None:
+            await self.connect()
+            self._conn = await learning_observer.redis.connection()
+        return self._conn
+
     async def __getitem__(self, key):
         '''
         Syntax:
 
         >> await kvs['item']
         '''
-        await self.connect()
-        connection = await learning_observer.redis.connection()
+        connection = await self._connection()
         item = await connection.get(key)
         if item is not None:
             return json.loads(item)
         return None
 
+    async def mget(self, keys):
+        '''
+        Fetch several items at once, in one round-trip to redis.
+        Returns a list of values, in the same order as `keys`, with
+        `None` for missing items.
+        '''
+        if not keys:
+            return []
+        connection = await self._connection()
+        items = await (await connection.mget(keys)).aslist()
+        return [
+            json.loads(item) if item is not None else None
+            for item in items
+        ]
+
     async def set(self, key, value):
         '''
         Syntax:
@@ -156,22 +311,57 @@ class _RedisKVS(_KVS):
 
         So we use an explict set function.
         '''
-        await self.connect()
-        json.dumps(value)  # Fail early if we're not JSON
+        # Fail early if we're not JSON.
+        #
+        # `asyncio_redis`'s default encoder wants `str`, so we can't pass
+        # the bytes `orjson` gives us here.
+        payload = _ENCODE(value)
         assert isinstance(key, str), "KVS keys must be strings"
-        connection = await learning_observer.redis.connection()
-        await connection.set(key, json.dumps(value), expire=self.expire)
+        connection = await self._connection()
+        await self._store(connection, key, payload)
         return
 
-    async def keys(self):
+    async def _store(self, connection, key, payload):
         '''
-        Return all the keys in the KVS.
+        Write an encoded item to redis, with our expiry.
+        '''
+        await connection.set(key, payload, expire=self.expire)
 
-        This is obviously not very performant for large-scale dpeloys.
+    async def keys(self, pattern="*"):
         '''
-        await self.connect()
-        connection = await learning_observer.redis.connection()
-        return [await k for k in await connection.keys("*")]
+        Return all the keys in the KVS matching `pattern`, a redis-style
+        glob.
+
+        This is O(N) in the size of the keyspace, so it is obviously not
+        very performant for large-scale deploys. Use `iter_keys` to
+        stream keys instead.
+        '''
+        # `SCAN` may return a key more than once. `KEYS` didn't, and
+        # callers expect unique keys.
+        return list(dict.fromkeys([key async for key in self.iter_keys(pattern)]))
+
+    async def iter_keys(self, pattern="*"):
+        '''
+        Iterate over the keys in the KVS matching `pattern`.
+
+        We use `SCAN` rather than `KEYS`, so redis walks the keyspace in
+        small batches and can serve other clients in between, rather
+        than blocking until it has built the full list. Walking the
+        whole keyspace is still O(N). Like `SCAN`, this may yield a key
+        more than once.
+
+        Syntax:
+
+        >> async for key in kvs.iter_keys():
+        '''
+        connection = await self._connection()
+        cursor = await connection.scan(match=pattern)
+        cursor.count = _SCAN_COUNT
+        while True:
+            key = await cursor.fetchone()
+            if key is None:
+                return
+            yield key
 
 
 class EphemeralRedisKVS(_RedisKVS):
@@ -182,7 +372,7 @@ class EphemeralRedisKVS(_RedisKVS):
         '''
         We're just a `_RedisKVS` with expiration set
         '''
-        super().__init__(expire=learning_observer.settings.settings['kvs']['expiry'])
+        super().__init__(expire=CONFIG.expiry)
 
 
 class PersistentRedisKVS(_RedisKVS):
@@ -196,9 +386,23 @@ class PersistentRedisKVS(_RedisKVS):
         '''
         super().__init__(expire=None)
 
+    async def _store(self, connection, key, payload):
+        '''
+        Write an encoded item to redis. Nothing expires, so we send a
+        plain `SET`.
+        '''
+        await connection.set(key, payload)
+
 
 KVS = None
 
+# KVS settings, frozen by `kvs_startup_check` so we don't walk the
+# settings dictionaries each time we make a KVS.
+KVSConfig = collections.namedtuple(
+    'KVSConfig', ['type', 'expiry', 'inmemory_codec']
+)
+CONFIG = None
+
 
 @learning_observer.prestartup.register_startup_check
 def kvs_startup_check():
@@ -209,7 +413,7 @@ def kvs_startup_check():
 
     Checks like this one allow us to fail on startup, rather than later
     '''
-    global KVS
+    global KVS, CONFIG, _pack, _unpack
     try:
         KVS_MAP = {
             'stub': InMemoryKVS,
@@ -237,6 +441,27 @@ def kvs_startup_check():
                 "KVS incorrectly configured. Please fix the error, and\n"
                 "then replace this with a more meaningful error message"
             )
+    kvs_settings = learning_observer.settings.settings['kvs']
+    if KVS is EphemeralRedisKVS and 'expiry' not in kvs_settings:
+        raise learning_observer.prestartup.StartupCheck(
+            "The redis_ephemeral KVS needs an expiry. Please set\n"
+            "kvs.expiry in settings.py"
+        )
+    codec = kvs_settings.get('inmemory_codec', DEFAULT_INMEMORY_CODEC)
+    if codec not in INMEMORY_CODECS:
+        raise learning_observer.prestartup.StartupCheck(
+            "Unknown or unavailable in-memory KVS codec: {}\n"
+            "Is the library installed? Available codecs: {}".format(
+                codec,
+                list(INMEMORY_CODECS.keys())
+            )
+        )
+    _pack, _unpack = INMEMORY_CODECS[codec]
+    CONFIG = KVSConfig(
+        type=kvs_settings['type'],
+        expiry=kvs_settings.get('expiry', None),
+        inmemory_codec=codec
+    )
     return True
 
 
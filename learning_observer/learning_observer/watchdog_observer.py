@@ -20,21 +20,43 @@ import watchdog
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+import concurrent.futures
 import importlib
 import os
 import os.path
 import sys
+import threading
 import time
+import traceback
 import logging
 
+from importlib.machinery import SourceFileLoader
+
 from watchdog.observers import Observer
 from watchdog.events import LoggingEventHandler
 
 
 LOCAL_PATH = os.path.dirname(os.path.abspath(__file__))
 
+# Editors often write several events on save (write a temp file, rename,
+# chmod, ...). We wait this long (in seconds) after the last event
+# before restarting, so one save means one restart.
+RESTART_DELAY = 0.5
+
+
+def _path_prefixes(paths):
+    '''
+    Turn `paths` into a tuple of prefixes for `str.startswith`, which
+    checks all of them in one call. The trailing separator keeps
+    `/foo/bar` from matching `/foo/barbaz`.
+    '''
+    return tuple(os.path.join(path, '') for path in paths)
+
+
+_LOCAL_PATH_PREFIXES = _path_prefixes([LOCAL_PATH])
+
 
-def reimport_child_modules(paths=[LOCAL_PATH]):
+def reimport_child_modules(paths=None):
     '''
     Reload all modules which are in the given paths.
 
@@ -52,6 +74,12 @@ def reimport_child_modules(paths=[LOCAL_PATH]):
     reloaded = []
     failed = []
 
+    if paths is None:
+        prefixes = _LOCAL_PATH_PREFIXES
+    else:
+        prefixes = _path_prefixes(paths)
+    builtin_module_names = frozenset(sys.builtin_module_names)
+
     for module in modules:
         # Only reload modules that are in the specified paths,
         # and only if they are not system modules.
@@ -60,21 +88,23 @@ def reimport_child_modules(paths=[LOCAL_PATH]):
         # better safe than sorry. There is no ideal way to
         # determine if a module should be reloaded, so this
         # is a bit heuristic.
-        if not hasattr(module, '__file__'):
-            continue
-        if module.__file__ is None:
+        #
+        # Cheap checks go first, so we skip most modules quickly.
+        name = getattr(module, '__name__', None)
+        if name is None or name.startswith('_'):
             continue
-        if not module.__file__.endswith('.py'):
+        if name in builtin_module_names:
             continue
-        if not any(module.__file__.startswith(path) for path in paths):
+        module_file = getattr(module, '__file__', None)
+        if module_file is None:
             continue
-        if module.__name__.startswith('_'):
+        if not module_file.endswith('.py'):
             continue
-        if module.__name__ in sys.builtin_module_names:
+        if not module_file.startswith(prefixes):
             continue
-        if not os.path.exists(module.__file__):
+        if not os.path.exists(module_file):
             continue
-        if "SourceFileLoader" not in str(module.__loader__):
+        if not isinstance(getattr(module, '__loader__', None), SourceFileLoader):
             continue
         try:
             importlib.reload(module)
@@ -84,7 +114,10 @@ def reimport_child_modules(paths=[LOCAL_PATH]):
             print("Failed to reload %s" % module.__name__)
             traceback.print_exc()
             failed.append(module)
-    skipped = [m for m in modules if m not in reloaded and m not in failed]
+    # Look up by `id`, so this is a set lookup rather than a list scan.
+    # Not everything in `sys.modules` is guaranteed to be hashable.
+    touched = {id(m) for m in reloaded + failed}
+    skipped = [m for m in modules if id(m) not in touched]
     return {
         "reloaded": reloaded,
         "failed": failed,
@@ -92,6 +125,15 @@ def reimport_child_modules(paths=[LOCAL_PATH]):
     }
 
 
+def _is_python_source(path):
+    '''
+    Is `path` a Python source file (and not something in a cache)?
+    '''
+    if path is None:
+        return False
+    return path.endswith('.py') and '__pycache__' not in path
+
+
 def restart():
     '''
     Restart the system.
@@ -109,24 +151,58 @@ class RestartHandler(FileSystemEventHandler):
         self.shutdown = shutdown
         self.restart = restart
         self.start = start
+        self._pending = None
+        # Restarts run one at a time on a worker thread, so the watchdog
+        # thread is free to keep collecting events while we reload.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
 
     def on_any_event(self, event):
         '''
-        On any change in the file system, restart the server.
+        When a Python file changes, restart the server.
 
-        We should be more selective, looking only at Python files, config file,
-        and skipping cache files, but for now we'll restart on any change,
-        since this is helpful for testing this module.
+        Restarts are debounced: each event pushes the restart back by
+        `RESTART_DELAY`, so a burst of events gives one restart.
+
+        We should probably also restart on config file changes.
         '''
         if event.is_directory:
             return None
-        print("Reloading server")
-        self.shutdown()
-        # observer.stop()
-        # observer.join()
-        self.restart()
-        # We only make it beyond this point for some of the softer restarts.
-        self.start()
+        # Editors which save atomically write a temporary file, and then
+        # rename it over the original, so we check where files moved to
+        # as well.
+        changed = [event.src_path, getattr(event, 'dest_path', None)]
+        if not any(_is_python_source(path) for path in changed):
+            return None
+        if self._pending is not None:
+            self._pending.cancel()
+        self._pending = threading.Timer(
+            RESTART_DELAY,
+            self._executor.submit,
+            args=(self._do_restart,)
+        )
+        self._pending.start()
+
+    def _do_restart(self):
+        '''
+        Shut down, restart, and start the server again.
+
+        The lock keeps overlapping restarts from interleaving. We run
+        on an executor, and nobody looks at the returned future, so we
+        print errors here rather than lose them.
+        '''
+        with self._lock:
+            try:
+                print("Reloading server")
+                self.shutdown()
+                # observer.stop()
+                # observer.join()
+                self.restart()
+                # We only make it beyond this point for some of the softer restarts.
+                self.start()
+            except Exception:
+                print("Failed to reload server")
+                traceback.print_exc()
 
 
 def watchdog(handler=LoggingEventHandler()):
@@ -9,16 +9,20 @@ import dash_bootstrap_components as dbc
 # local imports
 from components import serve_layout
 
+_EXTERNAL_STYLESHEETS = (
+    dbc.themes.MINTY,  # bootstrap styling
+    dbc.icons.FONT_AWESOME,  # font awesome icons
+    'https://cdn.jsdelivr.net/gh/AnnMarieW/dash-bootstrap-templates@V1.0.6/dbc.min.css',  # styling dcc components as Bootstrap
+)
+
 app = dash.Dash(
     __name__,
     use_pages=True,
-    external_stylesheets=[
-        dbc.themes.MINTY,  # bootstrap styling
-        dbc.icons.FONT_AWESOME,  # font awesome icons
-        'https://cdn.jsdelivr.net/gh/AnnMarieW/dash-bootstrap-templates@V1.0.6/dbc.min.css',  # styling dcc components as Bootstrap
-    ],
+    external_stylesheets=list(_EXTERNAL_STYLESHEETS),
     title='Learning Observer',
-    suppress_callback_exceptions=True
+    suppress_callback_exceptions=True,
+    serve_locally=True,  # serve dash's own js/css rather than from a CDN
+    compress=True  # gzip responses (requires Flask-Compress)
 )
 
 # register extra pages, not created yet
@@ -28,4 +32,6 @@ dash.register_page('student', path='/student', layout=html.Div(['This page will
 app.layout = serve_layout
 
 if __name__ == '__main__':
-    app.run_server(debug=True, host='0.0.0.0')
+    # Debug mode adds the reloader and dev tools to every request. Dash
+    # turns it on if the `DASH_DEBUG` environment variable is set.
+    app.run_server(host='0.0.0.0')